@@ -96,8 +96,8 @@ def download_check(task):
     if not DOWNLOAD_CHECK:
         DOWNLOAD_CHECK = True
         checker = DownloaderCheck(task)
+        # fire and forget, the task does not wait for the stat request
         checker.start()
-        checker.join()
     logger.enable()
 
 
@@ -1598,6 +1598,12 @@ class DeepseekV2Model(DeepseekV2PretrainedModel):
             if self.config.use_flash_attention:
                 attention_mask = None if is_casual_mask(attention_mask) else attention_mask
 
+        if self.config.use_flash_attention:
+            # expand to the flashmask layout once here, instead of in every layer
+            attn_mask_startend_row_indices = fusion_ops.prepare_attn_mask_startend_row_indices(
+                attn_mask_startend_row_indices
+            )
+
         if self.config.num_nextn_predict_layers > 0:
             inputs_embeds_extra = inputs_embeds[:, -self.config.num_nextn_predict_layers :, :]  # [B, S, D]
             inputs_embeds = inputs_embeds[:, : -self.config.num_nextn_predict_layers, :]
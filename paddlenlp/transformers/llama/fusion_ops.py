@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib.util
 import os
+from functools import lru_cache
 
 import paddle
 import paddle.nn.functional as F
+from packaging import version
 
 try:
     from paddle.incubate.nn.functional import fused_rotary_position_embedding
@@ -34,6 +37,7 @@ except ImportError:
 
 from paddle.utils import try_import
 
+from paddlenlp.utils.log import logger
 from paddlenlp.utils.tools import get_env_device
 
 try:
@@ -54,6 +58,172 @@ except:
 from paddlenlp.transformers.refined_recompute import no_recompute
 from paddlenlp.transformers.ring_flash_attention import RingFlashAttention
 
+_DEV = get_env_device()
+# (major, minor, patch) of the installed paddle, develop builds report (0, 0, 0)
+_PADDLE_VER = version.parse(paddle.version.full_version).release
+_IS_PADDLE_DEVELOP = _PADDLE_VER == (0, 0, 0)
+
+# paddle version > 2.6 or develop support q and k/v with different num_heads in fused rope and flash attention
+PADDLE_SUPPORT_GQA = _IS_PADDLE_DEVELOP or _PADDLE_VER >= (2, 7, 0)
+
+USE_LEGACY_FLASH_ATTENTION = not _IS_PADDLE_DEVELOP and _PADDLE_VER <= (2, 5, 2)
+
+# paddle releases shipping paddle.nn.functional.sdpa pick the scaled_dot_product_attention backend from the
+# inputs (place, dtype, mask). Older ones send masked calls to the flash kernel, even on cpu, pre-Ampere gpus
+# or fp32 inputs that it cannot run.
+SDPA_SELECTS_BACKEND = importlib.util.find_spec("paddle.nn.functional.sdpa") is not None
+
+
+# causal attention without mask goes to flash_attention directly, bypassing the backend selection of
+# scaled_dot_product_attention. Short queries stay on sdpa where the launch overhead dominates, and
+# anything flash cannot run (fp32, pre-Ampere gpus, non-square causal) is left to sdpa as well.
+@lru_cache(maxsize=None)
+def use_direct_flash_attention():
+    # resolved on the first attention call rather than at import, so importing the models does not
+    # initialize a cuda context and paddle.set_device can still take effect before
+    if _DEV != "gpu" or flash_attention is None:
+        return False
+    try:
+        # the flash attention kernels need sm80 (Ampere) or newer
+        major, _ = paddle.device.cuda.get_device_capability()
+    except Exception:
+        return False
+    return major >= 8
+
+
+DIRECT_FLASH_ATTENTION_MIN_SEQ_LEN = 128
+# largest head_dim supported by the flash attention kernels
+FLASH_ATTENTION_MAX_HEAD_DIM = 256
+
+
+# flashmask_attention takes startend_row_indices in [bsz, num_heads, seq_len, {1, 2, 4}], the older
+# flash_attention_with_sparse_mask takes start_row_indices in [bsz, num_heads, seq_len]
+if hasattr(F, "flashmask_attention"):
+    flashmask_attention = F.flashmask_attention
+    FLASHMASK_EXPECTS_4D = True
+else:
+    flashmask_attention = getattr(F, "flash_attention_with_sparse_mask", None)
+    FLASHMASK_EXPECTS_4D = False
+
+
+def prepare_attn_mask_startend_row_indices(attn_mask_startend_row_indices):
+    """
+    Normalize `attn_mask_startend_row_indices` to the layout expected by the bound flashmask api. Inputs that are
+    already in that layout are returned as is, so the normalization can be done once before the decoder layers.
+    """
+    if attn_mask_startend_row_indices is None:
+        return None
+    if len(attn_mask_startend_row_indices.shape) == 2:
+        # [bsz, seq_len] -> [bsz, 1, seq_len]
+        attn_mask_startend_row_indices = attn_mask_startend_row_indices.unsqueeze(1)
+    if FLASHMASK_EXPECTS_4D and len(attn_mask_startend_row_indices.shape) == 3:
+        # [bsz, num_heads, seq_len] -> [bsz, num_heads, seq_len, 1]
+        attn_mask_startend_row_indices = attn_mask_startend_row_indices.unsqueeze(-1)
+    return attn_mask_startend_row_indices
+
+
+def _get_rope_cos_sin(rotary_emb, value_states, kv_seq_len, cos_sin_cache=None):
+    # reuse the cos/sin built once by the model when it covers the current kv_seq_len
+    if cos_sin_cache is not None and cos_sin_cache[0].shape[1] == kv_seq_len:
+        cos, sin = cos_sin_cache
+        if cos.dtype != value_states.dtype:
+            cos, sin = cos.cast(value_states.dtype), sin.cast(value_states.dtype)
+        return cos, sin
+    return rotary_emb(value_states, seq_len=kv_seq_len)
+
+
+def _rope_npu(
+    query_states, key_states, value_states, position_ids, past_key_value, rotary_emb, kv_seq_len, cos_sin_cache
+):
+    assert past_key_value is None, "fuse rotary not support cache kv for now"
+    cos, sin = _get_rope_cos_sin(rotary_emb, value_states, kv_seq_len, cos_sin_cache)
+    query_states = core.eager._run_custom_op("fused_rope", query_states, cos, sin)[0]
+    key_states = core.eager._run_custom_op("fused_rope", key_states, cos, sin)[0]
+    return query_states, key_states
+
+
+def _rope_intel_hpu(
+    query_states, key_states, value_states, position_ids, past_key_value, rotary_emb, kv_seq_len, cos_sin_cache
+):
+    if past_key_value is not None:
+        kv_seq_len += past_key_value[0].shape[-3]
+    # cos/sin shared by the model are already in [1, 1, seq_len, head_dim]
+    if cos_sin_cache is not None and cos_sin_cache[0].shape[2] == kv_seq_len:
+        cos, sin = cos_sin_cache
+        if cos.dtype != value_states.dtype:
+            cos, sin = cos.cast(value_states.dtype), sin.cast(value_states.dtype)
+    else:
+        cos, sin = rotary_emb(value_states, seq_len=kv_seq_len)
+        cos = cos.squeeze().unsqueeze(0).unsqueeze(0)
+        sin = sin.squeeze().unsqueeze(0).unsqueeze(0)
+    query_states, _, _ = paddle.incubate.nn.functional.fused_rotary_position_embedding(
+        paddle.transpose(query_states, [0, 2, 1, 3]), None, None, sin=sin, cos=cos, position_ids=position_ids
+    )
+    key_states, _, _ = paddle.incubate.nn.functional.fused_rotary_position_embedding(
+        paddle.transpose(key_states, [0, 2, 1, 3]), None, None, sin=sin, cos=cos, position_ids=position_ids
+    )
+    query_states = paddle.transpose(query_states, [0, 2, 1, 3])
+    key_states = paddle.transpose(key_states, [0, 2, 1, 3])
+    return query_states, key_states
+
+
+def _rope_gcu(
+    query_states, key_states, value_states, position_ids, past_key_value, rotary_emb, kv_seq_len, cos_sin_cache
+):
+    # the table of scaled ropes (e.g. dynamic ntk) depends on the sequence length, only reuse a matching one
+    if cos_sin_cache is not None and cos_sin_cache.shape[0] == kv_seq_len:
+        cos_sin = (
+            cos_sin_cache if cos_sin_cache.dtype == value_states.dtype else cos_sin_cache.cast(value_states.dtype)
+        )
+    else:
+        cos_sin = rotary_emb.get_fused_cos_sin(value_states, seq_len=kv_seq_len)
+    query_states, key_states = core.eager._run_custom_op(
+        "fused_rotary_embedding_gcu", query_states, key_states, cos_sin, position_ids, True
+    )
+    return query_states, key_states
+
+
+def _rope_default(
+    query_states, key_states, value_states, position_ids, past_key_value, rotary_emb, kv_seq_len, cos_sin_cache
+):
+    assert past_key_value is None, "fuse rotary not support cache kv for now"
+    cos, sin = _get_rope_cos_sin(rotary_emb, value_states, kv_seq_len, cos_sin_cache)
+    # rotate q and k in one dispatch, only legacy paddle needs separate calls for gqa/mqa
+    if not PADDLE_SUPPORT_GQA and query_states.shape[2] != key_states.shape[2]:
+        query_states, _, _ = fused_rotary_position_embedding(
+            query_states,
+            None,
+            None,
+            sin=sin,
+            cos=cos,
+            position_ids=position_ids,
+            use_neox_rotary_style=False,
+        )
+        key_states, _, _ = fused_rotary_position_embedding(
+            key_states,
+            None,
+            None,
+            sin=sin,
+            cos=cos,
+            position_ids=position_ids,
+            use_neox_rotary_style=False,
+        )
+    else:
+        query_states, key_states, _ = fused_rotary_position_embedding(
+            query_states,
+            key_states,
+            v=None,
+            sin=sin,
+            cos=cos,
+            position_ids=position_ids,
+            use_neox_rotary_style=False,
+        )
+    return query_states, key_states
+
+
+# bind the device specific implementation once instead of walking the device ladder on every call
+_rope_impl = {"npu": _rope_npu, "intel_hpu": _rope_intel_hpu, "gcu": _rope_gcu}.get(_DEV, _rope_default)
+
 
 def fusion_rope(
     query_states,
@@ -64,103 +234,268 @@ def fusion_rope(
     past_key_value,
     rotary_emb,
     context_parallel_degree=-1,
+    cos_sin_cache=None,
 ):
-    if get_env_device() not in ["gcu", "intel_hpu"]:
-        assert past_key_value is None, "fuse rotary not support cache kv for now"
-    batch_size, seq_length, num_heads, head_dim = query_states.shape
-    _, kv_seq_len, num_key_value_heads, _ = key_states.shape
+    kv_seq_len = key_states.shape[1]
     if context_parallel_degree > 1:
-        assert get_env_device() == "gpu", "context parallel only support cuda device for now"
+        assert _DEV == "gpu", "context parallel only support cuda device for now"
         kv_seq_len *= context_parallel_degree
-    if get_env_device() not in ["gcu", "intel_hpu"]:
-        cos, sin = rotary_emb(value_states, seq_len=kv_seq_len)
-    if get_env_device() == "npu":
-        query_states = core.eager._run_custom_op("fused_rope", query_states, cos, sin)[0]
-        key_states = core.eager._run_custom_op("fused_rope", key_states, cos, sin)[0]
-    elif get_env_device() == "intel_hpu":
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-3]
-        cos, sin = rotary_emb(value_states, seq_len=kv_seq_len)
+    return _rope_impl(
+        query_states, key_states, value_states, position_ids, past_key_value, rotary_emb, kv_seq_len, cos_sin_cache
+    )
+
+
+def get_rope_cos_sin_cache(rotary_emb, x, seq_len):
+    """
+    Build the cos/sin tables consumed by `fusion_rope` once per forward, so that all layers can share them
+    instead of calling `rotary_emb` layer by layer.
+    """
+    if _DEV == "gcu":
+        # [seq_len, head_dim], trimmed so that the layers can check it against their kv_seq_len
+        return rotary_emb.get_fused_cos_sin(x, seq_len=seq_len)[:seq_len]
+    cos, sin = rotary_emb(x, seq_len=seq_len)
+    if _DEV == "intel_hpu":
+        # [1, seq_len, 1, head_dim] -> [1, 1, seq_len, head_dim], done once instead of per layer
         cos = cos.squeeze().unsqueeze(0).unsqueeze(0)
         sin = sin.squeeze().unsqueeze(0).unsqueeze(0)
-        query_states, _, _ = paddle.incubate.nn.functional.fused_rotary_position_embedding(
-            paddle.transpose(query_states, [0, 2, 1, 3]), None, None, sin=sin, cos=cos, position_ids=position_ids
-        )
-        key_states, _, _ = paddle.incubate.nn.functional.fused_rotary_position_embedding(
-            paddle.transpose(key_states, [0, 2, 1, 3]), None, None, sin=sin, cos=cos, position_ids=position_ids
-        )
-        query_states = paddle.transpose(query_states, [0, 2, 1, 3])
-        key_states = paddle.transpose(key_states, [0, 2, 1, 3])
-    elif get_env_device() == "gcu":
-        cos_sin = rotary_emb.get_fused_cos_sin(value_states, seq_len=kv_seq_len)
-        query_states, key_states = core.eager._run_custom_op(
-            "fused_rotary_embedding_gcu", query_states, key_states, cos_sin, position_ids, True
+    return cos, sin
+
+
+# resolve the optional rms_norm extensions once instead of looking them up per layer per step. A broken
+# custom op build raises more than ImportError on load, it must not break importing the models.
+try:
+    import fast_ln
+except Exception:
+    fast_ln = None
+try:
+    import fused_ln
+except Exception:
+    fused_ln = None
+
+# single-pass triton rms_norm from paddlenlp_kernel, the fallback when the extensions above are missing
+triton_rms_norm = None
+if _DEV == "gpu" and (fast_ln is None or fused_ln is None):
+    try:
+        from paddlenlp_kernel.triton.mamba.layer_norm import (
+            rms_norm_fn as triton_rms_norm,
         )
-    else:
-        # paddle version > 2.6 or develop support q and k/v with different num_heads
-        paddle_version = float(paddle.__version__[:3])
-        if ((paddle_version != 0.0) and (paddle_version <= 2.6)) and (num_heads != num_key_value_heads):
-            query_states, _, _ = fused_rotary_position_embedding(
-                query_states,
-                None,
-                None,
-                sin=sin,
-                cos=cos,
-                position_ids=position_ids,
-                use_neox_rotary_style=False,
-            )
-            key_states, _, _ = fused_rotary_position_embedding(
-                key_states,
-                None,
-                None,
-                sin=sin,
-                cos=cos,
-                position_ids=position_ids,
-                use_neox_rotary_style=False,
-            )
-        else:
-            query_states, key_states, _ = fused_rotary_position_embedding(
-                query_states,
-                key_states,
-                v=None,
-                sin=sin,
-                cos=cos,
-                position_ids=position_ids,
-                use_neox_rotary_style=False,
-            )
-    return query_states, key_states
+    except:
+        triton_rms_norm = None
 
 
 def rms_norm_fused(x_in, w, eps, use_fast_ln=False):
-    if use_fast_ln:
-        fast_ln = try_import("fast_ln")
+    if use_fast_ln and fast_ln is not None:
         return fast_ln.fast_rms_norm(x_in, w, eps)[0]
-    else:
-        fused_ln = try_import("fused_ln")
+    if not use_fast_ln and fused_ln is not None:
         return fused_ln.fused_rms_norm(x_in, w, eps)[0]
+    if triton_rms_norm is not None:
+        return triton_rms_norm(x_in, w, None, eps=eps)
+    # try_import raises a readable error with install hints when the extension is missing
+    if use_fast_ln:
+        return try_import("fast_ln").fast_rms_norm(x_in, w, eps)[0]
+    return try_import("fused_ln").fused_rms_norm(x_in, w, eps)[0]
+
+
+def _rms_norm_custom_op(op_name):
+    def _rms_norm(hidden_states, weight, variance_epsilon, use_fast_ln=False):
+        return core.eager._run_custom_op(op_name, hidden_states, weight, variance_epsilon)[0]
+
+    return _rms_norm
+
+
+def _rms_norm_intel_hpu(hidden_states, weight, variance_epsilon, use_fast_ln=False):
+    return paddle.incubate.nn.functional.fused_rms_norm(
+        hidden_states, weight, None, variance_epsilon, hidden_states.dim() - 1
+    )[0]
+
+
+def _rms_norm_xpu(hidden_states, weight, variance_epsilon, use_fast_ln=False):
+    try:
+        import paddle_xpu_nn  # noqa: F821
+
+        return paddle_xpu_nn.xpu_rms_norm(hidden_states, weight, variance_epsilon)[0]
+    except ImportError:
+        raise NotImplementedError(
+            f"Implementation of fused_rms_norm is not available on {_DEV}. Please install paddle_xpu to use this feature"
+        )
+
+
+if _DEV in ["npu", "mlu", "gcu"]:
+    _rms_norm_impl = _rms_norm_custom_op(f"rms_norm_{_DEV}")
+elif _DEV == "intel_hpu":
+    _rms_norm_impl = _rms_norm_intel_hpu
+elif _DEV == "xpu":
+    _rms_norm_impl = _rms_norm_xpu
+else:
+    _rms_norm_impl = rms_norm_fused
 
 
 def fusion_rms_norm(hidden_states, weight, variance_epsilon, use_fast_ln=False):
-    if get_env_device() == "npu":
-        return core.eager._run_custom_op("rms_norm_npu", hidden_states, weight, variance_epsilon)[0]
-    if get_env_device() == "mlu":
-        return core.eager._run_custom_op("rms_norm_mlu", hidden_states, weight, variance_epsilon)[0]
-    elif get_env_device() == "gcu":
-        return core.eager._run_custom_op("rms_norm_gcu", hidden_states, weight, variance_epsilon)[0]
-    elif get_env_device() == "intel_hpu":
-        return paddle.incubate.nn.functional.fused_rms_norm(
-            hidden_states, weight, None, variance_epsilon, hidden_states.dim() - 1
-        )[0]
-    elif get_env_device() == "xpu":
-        try:
-            import paddle_xpu_nn  # noqa: F821
-
-            return paddle_xpu_nn.xpu_rms_norm(hidden_states, weight, variance_epsilon)[0]
-        except ImportError:
-            raise NotImplementedError(
-                f"Implementation of fused_rms_norm is not available on {get_env_device()}. Please install paddle_xpu to use this feature"
+    return _rms_norm_impl(hidden_states, weight, variance_epsilon, use_fast_ln)
+
+
+def _flash_attention_npu(
+    query_states,
+    key_states,
+    value_states,
+    attention_mask,
+    config,
+    alibi=None,
+    attn_mask_startend_row_indices=None,
+    npu_is_casual=False,
+    skip_recompute=False,
+):
+    if config.context_parallel_degree > 1:
+        raise ValueError("Context parallel is not implemented for npu")
+    return core.eager._run_custom_op(
+        "flash_attention_npu",
+        query_states,
+        key_states,
+        value_states,
+        None,
+        attention_mask,
+        None,
+        None,
+        0.0,
+        attention_mask is None,
+        True,
+        False,
+        npu_is_casual,
+        False,
+    )[0]
+
+
+def _flash_attention_gcu(
+    query_states,
+    key_states,
+    value_states,
+    attention_mask,
+    config,
+    alibi=None,
+    attn_mask_startend_row_indices=None,
+    npu_is_casual=False,
+    skip_recompute=False,
+):
+    if config.context_parallel_degree > 1:
+        raise ValueError("Context parallel is not implemented for gcu")
+    return core.eager._run_custom_op(
+        "fused_sdp_flash_attention_gcu",
+        query_states,
+        key_states,
+        value_states,
+        attention_mask,
+        0.0,
+        attention_mask is None,
+        True,
+    )[0]
+
+
+def _flash_attention_intel_hpu(
+    query_states,
+    key_states,
+    value_states,
+    attention_mask,
+    config,
+    alibi=None,
+    attn_mask_startend_row_indices=None,
+    npu_is_casual=False,
+    skip_recompute=False,
+):
+    if config.context_parallel_degree > 1:
+        raise ValueError("Context parallel is not implemented for intel_hpu")
+    scaling_factor = query_states.shape[3] ** -0.5
+    attention_mask = attention_mask.astype(query_states.dtype)
+    return paddle.incubate.nn.functional.fused_dot_product_attention(
+        query_states,
+        key_states,
+        value_states,
+        attention_mask,
+        0.0,
+        attention_mask is None,
+        scaling_factor,
+        False,
+    )
+
+
+def _flash_attention_default(
+    query_states,
+    key_states,
+    value_states,
+    attention_mask,
+    config,
+    alibi=None,
+    attn_mask_startend_row_indices=None,
+    npu_is_casual=False,
+    skip_recompute=False,
+):
+    if config.context_parallel_degree > 1:
+        return RingFlashAttention.apply(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=None,
+            is_causal=True,
+        )
+    if attn_mask_startend_row_indices is not None:
+        assert alibi is None, "flashmask_attention or flash_attention_with_sparse_mask not support alibi"
+        attn_mask_startend_row_indices = prepare_attn_mask_startend_row_indices(attn_mask_startend_row_indices)
+        if FLASHMASK_EXPECTS_4D:
+            return no_recompute(
+                flashmask_attention,
+                query_states,
+                key_states,
+                value_states,
+                startend_row_indices=attn_mask_startend_row_indices,
+                causal=True,
+                enable=skip_recompute,
             )
-    return rms_norm_fused(hidden_states, weight, variance_epsilon, use_fast_ln)
+        return no_recompute(
+            flashmask_attention,
+            query_states,
+            key_states,
+            value_states,
+            attn_mask_start_row_indices=attn_mask_startend_row_indices,
+            is_causal=True,
+            enable=skip_recompute,
+        )
+    _, q_len, _, head_dim = query_states.shape
+    if head_dim > FLASH_ATTENTION_MAX_HEAD_DIM:
+        logger.warning_once(
+            f"head_dim {head_dim} is larger than {FLASH_ATTENTION_MAX_HEAD_DIM}, which flash attention kernels do "
+            "not support. Falling back to scaled_dot_product_attention, which may be much slower."
+        )
+    elif (
+        use_direct_flash_attention()
+        and attention_mask is None
+        and q_len > DIRECT_FLASH_ATTENTION_MIN_SEQ_LEN
+        and q_len == key_states.shape[1]
+        and query_states.dtype in (paddle.float16, paddle.bfloat16)
+    ):
+        attn_output, _ = no_recompute(
+            flash_attention,
+            query_states,
+            key_states,
+            value_states,
+            causal=True,
+            enable=skip_recompute,
+        )
+        return attn_output
+    return no_recompute(
+        F.scaled_dot_product_attention,
+        query_states,
+        key_states,
+        value_states,
+        attn_mask=attention_mask,
+        is_causal=q_len != 1,
+        enable=skip_recompute,
+    )
+
+
+_flash_attention_impl = {
+    "npu": _flash_attention_npu,
+    "gcu": _flash_attention_gcu,
+    "intel_hpu": _flash_attention_intel_hpu,
+}.get(_DEV, _flash_attention_default)
 
 
 def fusion_flash_attention(
@@ -178,15 +513,14 @@ def fusion_flash_attention(
     skip_recompute=False,
 ):
     # Note:
-    # 1. The head_dim of query_states and key_states should be the same. And the head_dim of value_states should be used for reshape.
-    bsz, q_len, num_heads, _ = query_states.shape
-    _, kv_seq_len, _, head_dim = value_states.shape
-    version = paddle.version.full_version
-    if version != "0.0.0" and version <= "2.5.2":
+    # 1. The head_dim of query_states and key_states should be the same. The output keeps the head_dim of value_states.
+    # 2. The query shape is only read by the alibi and sep parallel branches, the flash attention implementations
+    #    read what they need themselves.
+    if USE_LEGACY_FLASH_ATTENTION:
         if alibi is not None:
             raise ValueError("Flash Attention doesn't support alibi")
         if config.context_parallel_degree > 1:
-            raise ValueError(f"Context parallel is not implemented in version {version}")
+            raise ValueError(f"Context parallel is not implemented in version {paddle.version.full_version}")
         attn_output, attn_weights = flash_attention(
             query_states,
             key_states,
@@ -196,100 +530,20 @@ def fusion_flash_attention(
         )
     else:
         if alibi is not None:
+            bsz, _, num_heads, _ = query_states.shape
             alibi = alibi.reshape([bsz, num_heads, 1, -1])
             attention_mask = attention_mask.cast(alibi.dtype) + alibi
-        if get_env_device() == "npu":
-            if config.context_parallel_degree > 1:
-                raise ValueError("Context parallel is not implemented for npu")
-            attn_output = core.eager._run_custom_op(
-                "flash_attention_npu",
-                query_states,
-                key_states,
-                value_states,
-                None,
-                attention_mask,
-                None,
-                None,
-                0.0,
-                attention_mask is None,
-                True,
-                False,
-                npu_is_casual,
-                False,
-            )[0]
-        elif get_env_device() == "gcu":
-            if config.context_parallel_degree > 1:
-                raise ValueError("Context parallel is not implemented for gcu")
-            attn_output = core.eager._run_custom_op(
-                "fused_sdp_flash_attention_gcu",
-                query_states,
-                key_states,
-                value_states,
-                attention_mask,
-                0.0,
-                attention_mask is None,
-                True,
-            )[0]
-        elif get_env_device() == "intel_hpu":
-            if config.context_parallel_degree > 1:
-                raise ValueError("Context parallel is not implemented for intel_hpu")
-            scaling_factor = query_states.shape[3] ** -0.5
-            attention_mask = attention_mask.astype(query_states.dtype)
-            attn_output = paddle.incubate.nn.functional.fused_dot_product_attention(
-                query_states,
-                key_states,
-                value_states,
-                attention_mask,
-                0.0,
-                attention_mask is None,
-                scaling_factor,
-                False,
-            )
-        else:
-            if config.context_parallel_degree > 1:
-                attn_output = RingFlashAttention.apply(
-                    query_states,
-                    key_states,
-                    value_states,
-                    attn_mask=None,
-                    is_causal=True,
-                )
-            else:
-                if attn_mask_startend_row_indices is not None:
-                    assert alibi is None, "flashmask_attention or flash_attention_with_sparse_mask not support alibi"
-                    if len(attn_mask_startend_row_indices.shape) == 2:
-                        attn_mask_startend_row_indices = paddle.unsqueeze(attn_mask_startend_row_indices, axis=1)
-
-                    if hasattr(F, "flashmask_attention"):
-                        attn_output = no_recompute(
-                            F.flashmask_attention,
-                            query_states,
-                            key_states,
-                            value_states,
-                            startend_row_indices=attn_mask_startend_row_indices.unsqueeze(-1),
-                            causal=True,
-                            enable=skip_recompute,
-                        )
-                    else:
-                        attn_output = no_recompute(
-                            F.flash_attention_with_sparse_mask,
-                            query_states,
-                            key_states,
-                            value_states,
-                            attn_mask_start_row_indices=attn_mask_startend_row_indices,
-                            is_causal=True,
-                            enable=skip_recompute,
-                        )
-                else:
-                    attn_output = no_recompute(
-                        F.scaled_dot_product_attention,
-                        query_states,
-                        key_states,
-                        value_states,
-                        attn_mask=attention_mask,
-                        is_causal=query_states.shape[1] != 1,
-                        enable=skip_recompute,
-                    )
+        attn_output = _flash_attention_impl(
+            query_states,
+            key_states,
+            value_states,
+            attention_mask,
+            config,
+            alibi=alibi,
+            attn_mask_startend_row_indices=attn_mask_startend_row_indices,
+            npu_is_casual=npu_is_casual,
+            skip_recompute=skip_recompute,
+        )
         attn_weights = None
 
     if reshard_layer is not None:
@@ -300,14 +554,14 @@ def fusion_flash_attention(
             concat_axis=2,
         )
         # attn_output shape: [bs, seqlen/sep, num_head, head_dim]
+        q_len = query_states.shape[1]
         assert (
             config.sep_parallel_degree > 1 and q_len % config.sep_parallel_degree == 0
         ), f"q_len:{q_len}, config.sep_parallel_degree:{config.sep_parallel_degree}"
-        q_len = q_len // config.sep_parallel_degree
-        num_heads = num_heads * config.sep_parallel_degree
 
+    # [bs, seqlen, num_head, head_dim] -> [bs, seqlen, num_head * head_dim]
+    attn_output = attn_output.flatten(start_axis=2)
     if sequence_parallel:
-        attn_output = attn_output.reshape([bsz * q_len, head_dim * num_heads])
-    else:
-        attn_output = attn_output.reshape([bsz, q_len, head_dim * num_heads])
+        # -> [bs * seqlen, num_head * head_dim]
+        attn_output = attn_output.flatten(start_axis=0, stop_axis=1)
     return (attn_output, attn_weights) if output_attentions else attn_output
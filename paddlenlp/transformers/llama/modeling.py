@@ -18,7 +18,7 @@ from __future__ import annotations
 import math
 import os
 import warnings
-from functools import partial
+from functools import lru_cache, partial
 from typing import Optional, Tuple
 
 import numpy as np
@@ -108,11 +108,13 @@ __all__ = [
 ]
 
 
+@lru_cache()
 def _get_interleave(n):
+    # alibi slopes only depend on num_heads, compute them once and reuse across forwards
     def _get_interleave_power_of_2(n):
         start = 2 ** (-(2 ** -(np.log2(n) - 3)))
         ratio = start
-        return [start * ratio**i for i in range(n)]
+        return tuple(start * ratio**i for i in range(n))
 
     if np.log2(n).is_integer():
         return _get_interleave_power_of_2(n)
@@ -227,9 +229,6 @@ def scaled_dot_product_attention(
     npu_is_casual=False,
     skip_recompute=False,
 ):
-    bsz, q_len, num_heads, head_dim = query_states.shape
-    _, kv_seq_len, _, _ = value_states.shape
-
     if config.use_flash_attention and flash_attention:
         return fusion_ops.fusion_flash_attention(
             query_states,
@@ -253,6 +252,9 @@ def scaled_dot_product_attention(
         if config.context_parallel_degree > 1:
             raise ValueError("Context parallel requires `use_flash_attention=True`")
 
+        bsz, q_len, num_heads, head_dim = query_states.shape
+        _, kv_seq_len, _, _ = value_states.shape
+
         #  [ bz, seqlen, nhead, head_dim] -> [bs, nhead, seq_len, head_dim]
         query_states = paddle.transpose(query_states, [0, 2, 1, 3])
         # merge with the next tranpose
@@ -929,6 +931,7 @@ class LlamaAttention(nn.Layer):
         alibi: Optional[paddle.Tensor] = None,
         attn_mask_startend_row_indices: Optional[paddle.Tensor] = None,
         npu_is_casual: bool = False,
+        cos_sin_cache: Optional[Tuple[paddle.Tensor]] = None,
     ) -> Tuple[paddle.Tensor, Optional[paddle.Tensor], Optional[Tuple[paddle.Tensor]]]:
         """Input shape: Batch x Time x Channel"""
         # [bs, seq_len, num_head * head_dim] -> [seq_len / n, bs, num_head * head_dim] (n is model parallelism)
@@ -1073,6 +1076,7 @@ class LlamaAttention(nn.Layer):
                     past_key_value,
                     self.rotary_emb,
                     self.config.context_parallel_degree,
+                    cos_sin_cache=cos_sin_cache,
                 )
 
             else:
@@ -1108,8 +1112,7 @@ class LlamaAttention(nn.Layer):
         # TODO(wj-Mcat): use broadcast strategy when n_kv_heads = 1
         # repeat k/v heads if n_kv_heads < n_heads
         # paddle version > 2.6 or develop support flash-attn with gqa/mqa
-        paddle_version = float(paddle.__version__[:3])
-        if not self.config.use_flash_attention or ((paddle_version != 0.0) and (paddle_version <= 2.6)):
+        if not self.config.use_flash_attention or not fusion_ops.PADDLE_SUPPORT_GQA:
             key_states = repeat_kv(key_states, self.num_key_value_groups)
             value_states = repeat_kv(value_states, self.num_key_value_groups)
 
@@ -1205,6 +1208,7 @@ class LlamaDecoderLayer(nn.Layer):
         alibi: Optional[paddle.Tensor] = None,
         attn_mask_startend_row_indices: Optional[paddle.Tensor] = None,
         npu_is_casual: bool = False,
+        cos_sin_cache: Optional[Tuple[paddle.Tensor]] = None,
     ) -> Tuple[paddle.Tensor, Optional[Tuple[paddle.Tensor, paddle.Tensor]]]:
         """
         Args:
@@ -1218,6 +1222,8 @@ class LlamaDecoderLayer(nn.Layer):
                 If set to `True`, `cache` key value states are returned and can be used to speed up decoding
                 (see `cache`).
             cache (`Tuple(paddle.Tensor)`, *optional*): cached past key and value projection states
+            cos_sin_cache (`Tuple(paddle.Tensor)`, *optional*): rotary cos/sin tables shared by all layers,
+                only consumed by the fused rope path
         """
 
         # [bs * seq_len, embed_dim] -> [seq_len * bs / n, embed_dim] (sequence_parallel)
@@ -1256,6 +1262,7 @@ class LlamaDecoderLayer(nn.Layer):
                 alibi,
                 attn_mask_startend_row_indices=attn_mask_startend_row_indices,
                 npu_is_casual=npu_is_casual,
+                cos_sin_cache=cos_sin_cache,
             )
 
         if type(outputs) is tuple:
@@ -1632,10 +1639,12 @@ class LlamaModel(LlamaPretrainedModel):
         use_cache: bool,
         alibi=None,
         attn_mask_startend_row_indices=None,
+        cos_sin_cache=None,
     ):
         def create_custom_forward(module):
             def custom_forward(*inputs):
-                return module(*inputs)
+                # the rope tables never need gradients, hand them to the layer outside the recomputed inputs
+                return module(*inputs, cos_sin_cache=cos_sin_cache)
 
             return custom_forward
 
@@ -1746,6 +1755,19 @@ class LlamaModel(LlamaPretrainedModel):
         if position_ids is None:
             position_ids = paddle.arange(seq_length, dtype="int64").expand((batch_size, seq_length))
 
+        # cos/sin only depend on positions and head_dim, build them once and share across all layers
+        cos_sin_cache = None
+        if (
+            self.config.rope
+            and not self.config.use_long_sequence_strategies
+            and self.layers[0].self_attn.use_fused_rope
+        ):
+            cos_sin_cache = fusion_ops.get_rope_cos_sin_cache(
+                self.layers[0].self_attn.rotary_emb,
+                inputs_embeds,
+                seq_len=seq_length_with_past * max(self.config.context_parallel_degree, 1),
+            )
+
         use_casual_mask = get_use_casual_mask() and not self.config.alibi
 
         if self.config.use_flash_attention_for_generation or use_casual_mask:
@@ -1771,6 +1793,25 @@ class LlamaModel(LlamaPretrainedModel):
                     attention_mask = None
             else:
                 attention_mask = None if attention_mask is None else attention_mask.astype("bool")
+        if (
+            alibi is not None
+            and attention_mask is not None
+            and self.config.use_flash_attention
+            and flash_attention is not None
+            and not fusion_ops.USE_LEGACY_FLASH_ATTENTION
+            and self.config.sep_parallel_degree <= 1
+        ):
+            # fold alibi into the attention mask once here, instead of reshaping and adding it in every layer
+            alibi = alibi.reshape([batch_size, -1, 1, seq_length_with_past])
+            attention_mask = attention_mask.cast(alibi.dtype) + alibi
+            alibi = None
+
+        if self.config.use_flash_attention:
+            # expand to the flashmask layout once here, instead of in every layer
+            attn_mask_startend_row_indices = fusion_ops.prepare_attn_mask_startend_row_indices(
+                attn_mask_startend_row_indices
+            )
+
         hidden_states = inputs_embeds
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
@@ -1799,6 +1840,7 @@ class LlamaModel(LlamaPretrainedModel):
                     use_cache,
                     alibi=alibi,
                     attn_mask_startend_row_indices=attn_mask_startend_row_indices,
+                    cos_sin_cache=cos_sin_cache,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -1811,6 +1853,7 @@ class LlamaModel(LlamaPretrainedModel):
                     alibi=alibi,
                     attn_mask_startend_row_indices=attn_mask_startend_row_indices,
                     npu_is_casual=is_casual,
+                    cos_sin_cache=cos_sin_cache,
                 )
 
             # NOTE: clear outdate cache after it has been used for memory saving
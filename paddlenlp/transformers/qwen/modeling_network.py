@@ -15,7 +15,9 @@
 import math
 import os
 import warnings
+from functools import lru_cache
 
+import numpy as np
 import paddle
 import paddle.distributed as dist
 import paddle.nn.functional as F
@@ -26,7 +28,9 @@ from paddle.utils import try_import
 from paddlenlp.transformers.model_outputs import BaseModelOutputWithPast
 from paddlenlp.transformers.model_utils import PretrainedModel
 from paddlenlp.utils.log import logger
+from paddlenlp.utils.tools import get_env_device
 
+from ..llama import fusion_ops
 from .configuration import QWenConfig
 
 __all__ = [
@@ -65,10 +69,9 @@ def get_triangle_upper_mask(x, mask=None):
     if mask is not None:
         return mask
     # [bsz, n_head, q_len, kv_seq_len]
-    shape = x.shape
-    #  [bsz, 1, q_len, kv_seq_len]
-    shape[1] = 1
-    mask = paddle.full(shape, paddle.finfo(x.dtype).min, dtype=x.dtype)
+    _, _, q_len, kv_seq_len = x.shape
+    #  [1, 1, q_len, kv_seq_len], broadcasts over batch and heads
+    mask = paddle.full([1, 1, q_len, kv_seq_len], paddle.finfo(x.dtype).min, dtype=x.dtype)
     mask = paddle.triu(mask, diagonal=1)
     mask.stop_gradient = True
     return mask
@@ -85,6 +88,19 @@ def enable_fuse_ffn_qkv_pass():
         return False
 
 
+@lru_cache(maxsize=8)
+def _get_logn_list(seq_length):
+    # shared by every attention layer of a model, only depends on seq_length
+    positions = np.arange(1, MAX_NTK_SEQ_LENGTH)
+    return np.where(positions > seq_length, np.log(positions) / math.log(seq_length), 1.0)
+
+
+def _get_ntk_alpha(kv_seq_len, seq_length):
+    context_value = math.log(kv_seq_len / seq_length, 2) + 1
+    ntk_alpha = 2 ** math.ceil(context_value) - 1
+    return max(ntk_alpha, 1)
+
+
 attention_cnt = 0
 
 
@@ -120,11 +136,23 @@ class QWenAttentionNet(nn.Layer):
         dim = self.rotary_ndims if self.rotary_ndims is not None else self.hidden_size_per_attention_head
         self.rotary_emb = RotaryEmbedding(dim, base=config.rotary_emb_base)
 
+        self.use_fused_rope = config.use_fused_rope
+        if self.use_fused_rope:
+            if get_env_device() not in ["gpu", "xpu"] or fused_rotary_position_embedding is None:
+                warnings.warn(
+                    "Enable fuse rope in the config, but fuse rope is not available. "
+                    "Will disable fuse rope. Try using latest gpu version of Paddle."
+                )
+                self.use_fused_rope = False
+
         self.use_dynamic_ntk = config.use_dynamic_ntk
         self.use_logn_attn = config.use_logn_attn
 
-        logn_list = [math.log(i, self.seq_length) if i > self.seq_length else 1 for i in range(1, MAX_NTK_SEQ_LENGTH)]
-        self.logn_tensor = paddle.to_tensor(logn_list)[None, :, None, None]
+        self.register_buffer(
+            "logn_tensor",
+            paddle.to_tensor(_get_logn_list(self.seq_length), dtype=paddle.get_default_dtype())[None, :, None, None],
+            persistable=False,
+        )
         self._ntk_cached = 1.0
 
         self.attn_dropout = nn.Dropout(config.attn_dropout_prob)
@@ -132,36 +160,39 @@ class QWenAttentionNet(nn.Layer):
         self.attention_cnt = attention_cnt
         attention_cnt += 1
 
-    def _attn(self, query, key, value, attention_mask=None):
+    def _attn(self, query, key, value, attention_mask=None, output_attentions=False):
         # Support the flash attention and normal attention
-        bsz, q_len, num_heads, head_dim = query.shape
-        _, kv_seq_len, _, _ = value.shape
-        if self.config.use_flash_attention and flash_attention is not None:
+        use_flash_attention = self.config.use_flash_attention and flash_attention is not None
+        if use_flash_attention and fusion_ops.USE_LEGACY_FLASH_ATTENTION:
             # Flash Attention now ignore attention mask
             # Current Flash Attention doesn't support attn maskt
             # Paddle Flash Attention input [ bz, seqlen, nhead, head_dim]
             # Torch Flash Attention input [ bz, nhead, seqlen, head_dim]
-            version = paddle.version.full_version
-            if version != "0.0.0" and version <= "2.5.2":
-                attn_output, attn_weights = flash_attention(
-                    query,
-                    key,
-                    value,
-                    causal=query.shape[1] != 1,
-                    dropout=self.config.attn_dropout_prob,
-                    return_softmax=self.config.attn_dropout_prob > 0.0,
-                )
-            else:
-                attn_output = F.scaled_dot_product_attention(
-                    query,
-                    key,
-                    value,
-                    attn_mask=attention_mask,
-                    is_causal=attention_mask is None,
-                )
-                attn_weights = None
+            attn_output, attn_weights = flash_attention(
+                query,
+                key,
+                value,
+                causal=query.shape[1] != 1,
+                dropout=self.config.attn_dropout_prob,
+                return_softmax=self.config.attn_dropout_prob > 0.0,
+            )
             return attn_output, attn_weights
+        elif use_flash_attention or (not output_attentions and fusion_ops.SDPA_SELECTS_BACKEND):
+            # without flash attention the weights are only skipped when paddle can pick a backend that
+            # runs the mask on this device and dtype, otherwise fall back to the manual path below
+            attn_output = F.scaled_dot_product_attention(
+                query,
+                key,
+                value,
+                attn_mask=attention_mask,
+                dropout_p=self.config.attn_dropout_prob,
+                is_causal=attention_mask is None,
+                training=self.training,
+            )
+            return attn_output, None
         else:
+            bsz, q_len, num_heads, head_dim = query.shape
+            _, kv_seq_len, _, _ = value.shape
             # [bz, sql, nh, hid] ==> [bz, nh, sql hdim]
             query = query.transpose([0, 2, 1, 3])
             # [bz, sql, nh, hid] ==> [bz, nh, sql hdim]
@@ -169,7 +200,7 @@ class QWenAttentionNet(nn.Layer):
             # [bz, sql, nh, hid] ==> [bz, nh, sql hdim]
             value = value.transpose([0, 2, 1, 3])
 
-            attn_weights = paddle.matmul(query / math.sqrt(head_dim), key.transpose([0, 1, 3, 2]))
+            attn_weights = paddle.matmul(query * self.inv_norm_factor, key, transpose_y=True)
 
             if attn_weights.shape != [bsz, num_heads, q_len, kv_seq_len]:
                 raise ValueError(
@@ -189,15 +220,12 @@ class QWenAttentionNet(nn.Layer):
             return attn_output, attn_weights
 
     def _split_heads(self, tensor, num_heads, attn_head_size):
-        new_shape = tensor.shape[:-1] + [num_heads, attn_head_size]
-        tensor = tensor.reshape(new_shape)
-        return tensor
+        # [bz, sql, hid] ==> [bz, sql, nh, hdim], 0 keeps the input dim without reading the shape
+        return tensor.reshape([0, 0, num_heads, attn_head_size])
 
     def _merge_heads(self, tensor, num_heads, attn_head_size):
-        new_shape = tensor.shape[:-2] + [
-            num_heads * attn_head_size,
-        ]
-        return tensor.reshape(new_shape)
+        # [bz, sql, nh, hdim] ==> [bz, sql, hid]
+        return tensor.reshape([0, 0, num_heads * attn_head_size])
 
     def forward(
         self,
@@ -212,25 +240,25 @@ class QWenAttentionNet(nn.Layer):
     ):
         # # [bz, sql, hid] ==> [bz, sql, 3*hid]
         mixed_x_layer = self.c_attn(hidden_states)
-        # [bz, sql, 3*hid] ==> [bz, sql, hid]
-        target_shape = [0, 0, self.num_heads, 3 * self.head_dim]
+        # [bz, sql, 3*hid] ==> [bz, sql, nh, 3, hdim]
+        target_shape = [0, 0, self.num_heads, 3, self.head_dim]
 
         mixed_x_layer = paddle.reshape_(mixed_x_layer, target_shape)
-        query, key, value = paddle.split(mixed_x_layer, num_or_sections=3, axis=-1)
+        # [bz, sql, nh, 3, hdim] ==> 3 * [bz, sql, nh, hdim]
+        query, key, value = paddle.unbind(mixed_x_layer, axis=3)
 
         # [bz, sql, hid] ==> [bz, sql, nh, hdim]
         # query = self._split_heads(query, self.num_heads, self.head_dim)
         # key = self._split_heads(key, self.num_heads, self.head_dim)
         # value = self._split_heads(value, self.num_heads, self.head_dim)
 
-        kv_seq_len = hidden_states.shape[1]
+        q_len = hidden_states.shape[1]
+        kv_seq_len = q_len
         if layer_past:
             # layer past[0] shape: bs * seq_len * head_num * dim
             kv_seq_len += layer_past[0].shape[1]
-        if self.use_dynamic_ntk and kv_seq_len == hidden_states.shape[1] and not self.training:
-            context_value = math.log(kv_seq_len / self.seq_length, 2) + 1
-            ntk_alpha = 2 ** math.ceil(context_value) - 1
-            ntk_alpha = max(ntk_alpha, 1)
+        if self.use_dynamic_ntk and kv_seq_len == q_len and not self.training:
+            ntk_alpha = _get_ntk_alpha(kv_seq_len, self.seq_length)
             self._ntk_cached = ntk_alpha
         else:
             ntk_alpha = self._ntk_cached
@@ -244,7 +272,11 @@ class QWenAttentionNet(nn.Layer):
 
         if rotary_pos_emb is not None:
             cos, sin = rotary_pos_emb
-            if self.config.use_fused_rope:
+            if self.rotary_ndims is not None:
+                # rotary_pct < 1: only the leading rotary_ndims dims are rotated, the rest pass through
+                query, query_pass = query[..., : self.rotary_ndims], query[..., self.rotary_ndims :]
+                key, key_pass = key[..., : self.rotary_ndims], key[..., self.rotary_ndims :]
+            if self.use_fused_rope:
                 query, key, _ = fused_rotary_position_embedding(
                     query,
                     key,
@@ -256,6 +288,9 @@ class QWenAttentionNet(nn.Layer):
                 )
             else:
                 query, key = apply_rotary_pos_emb(query, key, cos, sin, position_ids=position_ids)
+            if self.rotary_ndims is not None:
+                query = paddle.concat([query, query_pass], axis=-1)
+                key = paddle.concat([key, key_pass], axis=-1)
 
         if layer_past is not None:
             past_key, past_value = layer_past[0], layer_past[1]
@@ -268,20 +303,30 @@ class QWenAttentionNet(nn.Layer):
             present = None
 
         if self.use_logn_attn and not self.training:
-            if self.logn_tensor.dtype != query.dtype:
-                self.logn_tensor = self.logn_tensor.astype(query.dtype)
-            seq_start = key.shape[1] - query.shape[1]
-            seq_end = key.shape[1]
-            logn_tensor = self.logn_tensor[:, seq_start:seq_end, :, :]
-            query = query * logn_tensor.expand(query.shape)
+            logn_tensor = self.logn_tensor[:, kv_seq_len - q_len : kv_seq_len, :, :]
+            if logn_tensor.dtype != query.dtype:
+                logn_tensor = logn_tensor.astype(query.dtype)
+            # [1, seq_len, 1, 1] broadcasts against query
+            query = query * logn_tensor
+
+        if attention_mask is not None and attention_mask.dtype != query.dtype:
+            # GlobalNet builds the mask in the hidden_states dtype, which is fp32 under amp O1 while q/k/v are
+            # low precision. Clip first so that finfo(fp32).min does not overflow to -inf in the attention dtype.
+            attention_mask = attention_mask.clip(min=paddle.finfo(query.dtype).min).astype(query.dtype)
 
         has_gradient = not (query.stop_gradient and key.stop_gradient and value.stop_gradient)
         if self.enable_recompute and self.training and has_gradient and self.recompute_granularity == "core_attn":
             attn_output, attn_weight = recompute(
-                self._attn, query, key, value, attention_mask, use_reentrant=self.config.recompute_use_reentrant
+                self._attn,
+                query,
+                key,
+                value,
+                attention_mask,
+                output_attentions,
+                use_reentrant=self.config.recompute_use_reentrant,
             )
         else:
-            attn_output, attn_weight = self._attn(query, key, value, attention_mask)
+            attn_output, attn_weight = self._attn(query, key, value, attention_mask, output_attentions)
         context_layer = self._merge_heads(attn_output, self.num_heads, self.head_dim)
 
         attn_output = self.c_proj(context_layer)
@@ -297,7 +342,9 @@ class QWenMLPNet(nn.Layer):
         super().__init__()
         ff_dim_in = config.intermediate_size // 2
         self.fuse_attention_ffn = config.fuse_attention_ffn
-        if self.fuse_attention_ffn and not enable_fuse_ffn_qkv_pass():
+        # resolved once, the env flag is not expected to change after the layer is built
+        self._fused_gate_up = self.fuse_attention_ffn and not enable_fuse_ffn_qkv_pass()
+        if self._fused_gate_up:
             self.gate_up_fused_proj = nn.Linear(config.hidden_size, ff_dim_in * 2, bias_attr=False)
         else:
             self.w1 = nn.Linear(config.hidden_size, ff_dim_in, bias_attr=False)
@@ -311,7 +358,7 @@ class QWenMLPNet(nn.Layer):
         # a2 = self.w2(hidden_states)
         # intermediate_parallel = a1 * F.silu(a2)
         # down
-        if self.fuse_attention_ffn and not enable_fuse_ffn_qkv_pass():
+        if self._fused_gate_up:
             intermediate_parallel = swiglu(self.gate_up_fused_proj(hidden_states))
         else:
             intermediate_parallel = swiglu(self.w2(hidden_states), self.w1(hidden_states))
@@ -354,10 +401,8 @@ class QWenBlockNet(nn.Layer):
 
         outputs = attn_outputs[1:]
 
-        residual = hidden_states
-        layernorm_input = attn_output + residual
-
-        layernorm_output = self.ln_2(layernorm_input)
+        # residual add and ln_2 in one pass when the fused kernel is available
+        layernorm_output, layernorm_input = self.ln_2(attn_output, residual=hidden_states)
 
         residual = layernorm_input
         mlp_output = self.mlp(layernorm_output)
@@ -491,7 +536,9 @@ class QWenModelNet(QWenPretrainedModelNet):
             attention_mask, position_ids, input_shape, past_length, hidden_states.dtype
         )
 
-        hidden_states = self.drop(hidden_states)
+        if self.training:
+            # nn.Dropout still launches an is_test kernel in eval, skip it there
+            hidden_states = self.drop(hidden_states)
         output_shape = input_shape + [
             hidden_states.shape[-1],
         ]
@@ -501,13 +548,14 @@ class QWenModelNet(QWenPretrainedModelNet):
                 logger.warning_once("`use_cache=True` is incompatible with recompute")
                 use_cache = False
 
-        presents = () if use_cache else None
-        all_self_attentions = () if output_attentions else None
-        all_hidden_states = () if output_hidden_states else None
+        # collected in lists and frozen to tuples once after the loop
+        presents = [] if use_cache else None
+        all_self_attentions = [] if output_attentions else None
+        all_hidden_states = [] if output_hidden_states else None
         for i, (block, layer_past) in enumerate(zip(self.h, past_key_values)):
             has_gradient = not hidden_states.stop_gradient
             if output_hidden_states:
-                all_hidden_states = all_hidden_states + (hidden_states,)
+                all_hidden_states.append(hidden_states)
             if self.enable_recompute and self.training and has_gradient and self.recompute_granularity == "full":
                 outputs = self.recompute_training(
                     block,
@@ -538,16 +586,20 @@ class QWenModelNet(QWenPretrainedModelNet):
                 hidden_states = outputs
 
             if use_cache is True:
-                presents = presents + (outputs[2 if output_attentions else 1],)
+                presents.append(outputs[2 if output_attentions else 1])
 
             if output_attentions:
-                all_self_attentions = all_self_attentions + (outputs[1],)
+                all_self_attentions.append(outputs[1])
 
         hidden_states = self.ln_f(hidden_states)
         hidden_states = hidden_states.reshape(output_shape)
         # Add last hidden state
         if output_hidden_states:
-            all_hidden_states = all_hidden_states + (hidden_states,)
+            all_hidden_states.append(hidden_states)
+
+        presents, all_self_attentions, all_hidden_states = (
+            tuple(v) if v is not None else None for v in (presents, all_self_attentions, all_hidden_states)
+        )
 
         if not return_dict:
             return tuple(v for v in [hidden_states, presents, all_hidden_states] if v is not None)
@@ -604,8 +656,10 @@ class QWenPretrainingCriterionNet(paddle.nn.Layer):
         with paddle.amp.auto_cast(False):
             masked_lm_loss = self.loss_func(prediction_scores.astype("float32"), masked_lm_labels.unsqueeze(2))
             # skip ignore_index which loss == 0
-            masked_lm_loss = paddle.masked_select(masked_lm_loss, masked_lm_loss > 0).astype("float32")
-            loss = paddle.mean(masked_lm_loss)
+            binary_sequence = (masked_lm_loss > 0).astype("float32")
+            # clip the count instead of masked_select/branching on it, so shapes and control flow stay static
+            count = paddle.clip(paddle.sum(binary_sequence), min=1.0)
+            loss = paddle.sum(masked_lm_loss * binary_sequence) / count
 
         return loss
 
@@ -707,46 +761,57 @@ class GlobalNet(nn.Layer):
     def __init__(self, config) -> None:
         super().__init__()
         self.config = config
+        # additive [1, 1, L, L] causal mask, grown geometrically and sliced for every forward
+        self._causal_mask_cache = None
+
+    def get_causal_mask(self, seq_length, past_length, dtype):
+        total_length = seq_length + past_length
+        causal_mask = self._causal_mask_cache
+        if (
+            paddle.in_dynamic_mode()
+            and causal_mask is not None
+            and causal_mask.shape[-1] >= total_length
+            and causal_mask.dtype == dtype
+        ):
+            return causal_mask[:, :, past_length:total_length, :total_length]
+
+        if past_length > 0 or not paddle.in_dynamic_mode():
+            # only the rows of the current queries, decoding must not rebuild a full mask for every new token
+            causal_mask = paddle.full([seq_length, total_length], paddle.finfo(dtype).min, dtype=dtype)
+            causal_mask = paddle.triu(causal_mask, diagonal=past_length + 1)[None, None, :, :]
+            causal_mask.stop_gradient = True
+            return causal_mask
+
+        cache_length = total_length
+        if causal_mask is not None:
+            cache_length = max(total_length, min(2 * causal_mask.shape[-1], self.config.max_position_embeddings))
+        causal_mask = paddle.full([cache_length, cache_length], paddle.finfo(dtype).min, dtype=dtype)
+        causal_mask = paddle.triu(causal_mask, diagonal=1)[None, None, :, :]
+        causal_mask.stop_gradient = True
+        self._causal_mask_cache = causal_mask
+        return causal_mask[:, :, :total_length, :total_length]
 
     def get_masks(self, batch_size, seq_length, past_length, dtype, padding_mask=None):
-        # casual mask
-        casual_mask = paddle.tril(paddle.ones([batch_size, 1, seq_length, seq_length], dtype="bool"))
-        if past_length > 0:
-            casual_mask = paddle.concat(
-                [paddle.ones([batch_size, 1, seq_length, past_length], dtype="bool"), casual_mask], axis=-1
-            )
-
-        # seq_mask
+        # [1, 1, seq_length, seq_length + past_length]
+        attention_mask = self.get_causal_mask(seq_length, past_length, dtype)
         if padding_mask is None:
-            padding_mask = paddle.ones((batch_size, 1, seq_length, seq_length + past_length), dtype="bool")
+            return attention_mask.expand([batch_size, 1, seq_length, seq_length + past_length])
+
         if len(padding_mask.shape) == 2:
-            # from Tokenizer
-            padding_mask = (
-                padding_mask.unsqueeze(axis=[1, 2])
-                .expand([batch_size, 1, seq_length, seq_length + past_length])
-                .astype("bool")
-            )
+            # from Tokenizer, [batch_size, src_length] -> [batch_size, 1, 1, src_length]
+            padding_mask = padding_mask.unsqueeze(axis=[1, 2])
         elif len(padding_mask.shape) == 3:
             # [batch_size,tgt_length, src_length] -> [batch_size, 1, tgt_length, src_length]
-            padding_mask = padding_mask.unsqueeze(1).astype("bool")
-        elif len(padding_mask.shape) == 4:
-            padding_mask = padding_mask.astype("bool")
-
-        casual_mask = casual_mask & padding_mask
+            padding_mask = padding_mask.unsqueeze(1)
+        padding_mask = padding_mask.astype("bool").expand([batch_size, 1, seq_length, seq_length + past_length])
 
-        return casual_mask
+        # dtype 4D mask
+        return paddle.where(padding_mask, attention_mask, paddle.full([], paddle.finfo(dtype).min, dtype=dtype))
 
     def forward(self, attention_mask, position_ids, input_shape, past_length, dtype):
-        # bool 4D mask
         attention_mask = self.get_masks(
             input_shape[0], input_shape[1], past_length, dtype=dtype, padding_mask=attention_mask
         )
-        # TODO(GhostScreaming): how to fix paddle.finfo?
-        zero = paddle.zeros(attention_mask.shape, dtype=paddle.bfloat16)
-        neg_inf = paddle.full_like(attention_mask, paddle.finfo(paddle.bfloat16).min, dtype=paddle.bfloat16)
-        # dtype 4D mask
-        attention_mask = paddle.where(attention_mask, zero, neg_inf)
-
         return attention_mask, position_ids
 
 
@@ -758,6 +823,9 @@ class RotaryEmbedding(nn.Layer):
         self.inv_freq = 1.0 / (self.base ** (paddle.cast(paddle.arange(0, self.dim, 2), dtype="float32") / self.dim))
         self._seq_len_cached = 0
         self._ntk_alpha_cached = 1.0
+        # cos/sin tables already cast to the dtype of the last input
+        self._cast_dtype = None
+        self._slice_key = None
 
     def update_cos_sin_cache(self, max_seq_len, offset=0, ntk_alpha=1.0):
         seqlen = max_seq_len + offset
@@ -772,15 +840,24 @@ class RotaryEmbedding(nn.Layer):
             emb = paddle.concat([freqs, freqs], axis=-1)
             self.cos_cached = emb.cos()[None, :, None, :]
             self.sin_cached = emb.sin()[None, :, None, :]
+            self._cast_dtype = None
 
     def forward(self, x, max_seq_len, offset=0, ntk_alpha=1.0):
         self.update_cos_sin_cache(max_seq_len, offset, ntk_alpha)
-        cos = self.cos_cached[:, offset : offset + max_seq_len, :, ...]
-        sin = self.sin_cached[:, offset : offset + max_seq_len, :, ...]
-        return (
-            cos.cast(x.dtype) if cos.dtype != x.dtype else cos,
-            sin.cast(x.dtype) if sin.dtype != x.dtype else sin,
-        )
+        if self._cast_dtype != x.dtype:
+            # cast the whole table once per dtype instead of the slices on every call
+            self._cos_cast = self.cos_cached.cast(x.dtype) if self.cos_cached.dtype != x.dtype else self.cos_cached
+            self._sin_cast = self.sin_cached.cast(x.dtype) if self.sin_cached.dtype != x.dtype else self.sin_cached
+            self._cast_dtype = x.dtype
+            self._slice_key = None
+        # fixed-shape training asks for the same window every step, reuse the last slice
+        if self._slice_key != (offset, max_seq_len) or not paddle.in_dynamic_mode():
+            self._cos_sin_slice = (
+                self._cos_cast[:, offset : offset + max_seq_len, :, ...],
+                self._sin_cast[:, offset : offset + max_seq_len, :, ...],
+            )
+            self._slice_key = (offset, max_seq_len)
+        return self._cos_sin_slice
 
 
 def rotate_half(x):
@@ -804,9 +881,40 @@ def apply_rotary_pos_emb(q, k, cos, sin, position_ids=None):
     return q_embed, k_embed
 
 
+try:
+    import fused_ln
+except ImportError:
+    fused_ln = None
+
+# paddle's built-in norm * weight cuda kernel, used when the fused_ln extension is not installed
+fused_rms_norm_ext = None
+if get_env_device() == "gpu":
+    try:
+        from paddle.incubate.nn.functional import fused_rms_norm_ext
+    except ImportError:
+        fused_rms_norm_ext = None
+
+# single-pass triton rms_norm from paddlenlp_kernel, only picked up when fused_ln is missing so that
+# every norm of a block (ln_1, ln_2 with its residual add, ln_f) runs on the same kernel
+triton_rms_norm = None
+if get_env_device() == "gpu" and fused_ln is None:
+    try:
+        from paddlenlp_kernel.triton.mamba.layer_norm import (
+            rms_norm_fn as triton_rms_norm,
+        )
+    except ImportError:
+        triton_rms_norm = None
+
+
 def rms_norm_fused(x_in, w, eps):
-    fused_ln = try_import("fused_ln")
-    return fused_ln.fused_rms_norm(x_in, w, eps)[0]
+    if fused_ln is not None:
+        return fused_ln.fused_rms_norm(x_in, w, eps)[0]
+    if triton_rms_norm is not None:
+        return triton_rms_norm(x_in, w, None, eps=eps)
+    if fused_rms_norm_ext is not None:
+        return fused_rms_norm_ext(x_in, w, eps)[0]
+    # try_import raises a readable error with install hints when the extension is missing
+    return try_import("fused_ln").fused_rms_norm(x_in, w, eps)[0]
 
 
 class QWenRMSNormNet(nn.Layer):
@@ -821,11 +929,22 @@ class QWenRMSNormNet(nn.Layer):
         )
 
     def _norm(self, x):
-        return x * paddle.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
+        # the variance is accumulated in fp32, which still materializes a full-size fp32 copy of x and its
+        # square, only the normalized output skips the fp32 round trip. use_fused_rms_norm avoids both.
+        variance = x.astype(paddle.float32).pow(2).mean(-1, keepdim=True)
+        return x * paddle.rsqrt(variance + self.eps).astype(x.dtype)
+
+    def forward(self, x, residual=None):
+        if residual is not None:
+            # returns (norm(x + residual), x + residual)
+            if self.config.use_fused_rms_norm and triton_rms_norm is not None:
+                return triton_rms_norm(x, self.weight, None, residual=residual, eps=self.eps, prenorm=True)
+            x = x + residual
+            return self.forward(x), x
 
-    def forward(self, x):
         if self.config.use_fused_rms_norm:
             return rms_norm_fused(x, self.weight, self.eps)
 
-        output = self._norm(x.astype(paddle.float32)).astype(x.dtype)
+        with paddle.amp.auto_cast(False):
+            output = self._norm(x)
         return output * self.weight
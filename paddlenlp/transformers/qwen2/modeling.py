@@ -681,8 +681,7 @@ class Qwen2Attention(nn.Layer):
 
         # TODO(wj-Mcat): use broadcast strategy when n_kv_heads = 1
         # repeat k/v heads if n_kv_heads < n_heads
-        paddle_version = float(paddle.__version__[:3])
-        if not self.config.use_flash_attention or ((paddle_version != 0.0) and (paddle_version <= 2.6)):
+        if not self.config.use_flash_attention or not fusion_ops.PADDLE_SUPPORT_GQA:
             key_states = repeat_kv(key_states, self.num_key_value_groups)
             value_states = repeat_kv(value_states, self.num_key_value_groups)
 
@@ -1297,6 +1296,12 @@ class Qwen2Model(Qwen2PretrainedModel):
             if self.config.use_flash_attention:
                 attention_mask = None if is_casual_mask(attention_mask) else attention_mask
 
+        if self.config.use_flash_attention:
+            # expand to the flashmask layout once here, instead of in every layer
+            attn_mask_startend_row_indices = fusion_ops.prepare_attn_mask_startend_row_indices(
+                attn_mask_startend_row_indices
+            )
+
         if position_ids is None:
             position_ids = paddle.arange(seq_length, dtype="int64").expand((batch_size, seq_length))
 
@@ -15,13 +15,16 @@ import hashlib
 import json
 import os
 import os.path as osp
+import queue
 import shutil
+import subprocess
 import tarfile
 import threading
 import time
 import uuid
 import zipfile
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Union
 
 import paddle.distributed as dist
@@ -29,7 +32,9 @@ import requests
 from filelock import FileLock
 from huggingface_hub import get_hf_file_metadata, hf_hub_url
 from huggingface_hub.utils import EntryNotFoundError
+from requests.adapters import HTTPAdapter
 from tqdm.auto import tqdm
+from urllib3.util.retry import Retry
 
 from .env import DOWNLOAD_SERVER, FAILED_STATUS, SUCCESS_STATUS
 from .fault_tolerance import PDC_DOWNLOAD_ERROR
@@ -48,8 +53,20 @@ __all__ = ["get_weights_path_from_url"]
 COMMUNITY_MODEL_PREFIX = os.getenv("COMMUNITY_MODEL_PREFIX", "https://bj.bcebos.com/paddlenlp/models/community")
 WEIGHTS_HOME = osp.expanduser("~/.cache/paddle/hapi/weights")
 DOWNLOAD_RETRY_LIMIT = 3
+# files at least this large are fetched as concurrent byte ranges when the server supports them
+DOWNLOAD_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+DOWNLOAD_PARALLEL_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# chunks buffered between the network reader and the disk writer of a single stream
+DOWNLOAD_WRITE_QUEUE_SIZE = 16
 DOWNLOAD_CHECK = False
 
+# shared keep-alive connection pool for the downloads of this process
+_SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.2))
+_SESSION.mount("http://", _HTTP_ADAPTER)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+
 nlp_models = OrderedDict(
     (
         ("RoBERTa-zh-base", "https://bert-models.bj.bcebos.com/chinese_roberta_wwm_ext_L-12_H-768_A-12.tar.gz"),
@@ -164,6 +181,18 @@ def get_path_from_url_with_filelock(
         str: the path of downloaded file
     """
 
+    # downloads are moved into place only once complete, so a verified file can be returned without the lock.
+    # archives still go through `get_path_from_url` to resolve their decompressed path.
+    fullpath = _map_path(url, root_dir)
+    if (
+        check_exist
+        and osp.isfile(fullpath)
+        and not (tarfile.is_tarfile(fullpath) or zipfile.is_zipfile(fullpath))
+        and _md5check(fullpath, md5sum)
+    ):
+        logger.info("Found {}".format(fullpath))
+        return fullpath
+
     os.makedirs(root_dir, exist_ok=True)
 
     # create lock file, which is empty, under the `LOCK_FILE_HOME` directory.
@@ -199,7 +228,7 @@ def _download(url, path, md5sum=None):
 
         logger.info("Downloading {} from {}".format(fname, url))
 
-        req = requests.get(url, stream=True)
+        req = _SESSION.get(url, stream=True)
         if req.status_code != 200:
             raise RuntimeError("Downloading from {} failed with code " "{}!".format(url, req.status_code))
 
@@ -208,35 +237,162 @@ def _download(url, path, md5sum=None):
         # after download finished
         tmp_fullname = fullname + "_tmp"
         total_size = req.headers.get("content-length")
-        with open(tmp_fullname, "wb") as f:
-            if total_size:
-                with tqdm(total=int(total_size), unit="B", unit_scale=True, unit_divisor=1024) as pbar:
-                    for chunk in req.iter_content(chunk_size=1024):
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-            else:
-                for chunk in req.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-        shutil.move(tmp_fullname, fullname)
+        if (
+            total_size
+            and int(total_size) >= DOWNLOAD_PARALLEL_MIN_SIZE
+            and req.headers.get("accept-ranges") == "bytes"
+            and req.headers.get("content-encoding", "identity") == "identity"
+        ):
+            # the ranged requests fetch the body, drop this one without reading it
+            req.close()
+            _download_ranges(req.url, tmp_fullname, int(total_size))
+        else:
+            with open(tmp_fullname, "wb") as f:
+                # a decoded (e.g. gzip) body does not match content-length, only reserve identity ones
+                if total_size and req.headers.get("content-encoding", "identity") == "identity":
+                    _preallocate(f, int(total_size))
+                if total_size:
+                    with tqdm(total=int(total_size), unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+                        _write_chunks(f, req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), pbar.update)
+                else:
+                    _write_chunks(f, req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE))
+                # drop any reserved space a short body did not fill
+                f.truncate()
+        # tmp_fullname sits next to fullname, so this is an atomic rename rather than a copy
+        os.replace(tmp_fullname, fullname)
 
     return fullname
 
 
+def _preallocate(f, size):
+    """
+    Size the file object `f` to `size` bytes, reserving the blocks up front where the
+    platform supports it so large downloads are not fragmented by many small appends.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # e.g. filesystems without fallocate support
+            pass
+    f.truncate(size)
+
+
+def _write_chunks(f, chunks, callback=None):
+    """
+    Write `chunks` to the file object `f` on a separate writer thread, so reading the
+    next chunk from the network overlaps with writing the previous one to disk.
+    `callback` is called with the size of every chunk handed to the writer.
+    """
+    buffers = queue.Queue(maxsize=DOWNLOAD_WRITE_QUEUE_SIZE)
+    errors = []
+
+    def _writer():
+        while True:
+            chunk = buffers.get()
+            if chunk is None:
+                return
+            # after a failure keep draining so the reader never blocks on a full queue
+            if errors:
+                continue
+            try:
+                f.write(chunk)
+            except Exception as e:
+                errors.append(e)
+
+    writer = threading.Thread(target=_writer, daemon=True)
+    writer.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            if chunk:
+                buffers.put(chunk)
+                if callback is not None:
+                    callback(len(chunk))
+    finally:
+        buffers.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def _download_ranges(url, tmp_fullname, total_size, num_workers=DOWNLOAD_PARALLEL_WORKERS):
+    """
+    Download `total_size` bytes from url to tmp_fullname with `num_workers` concurrent
+    HTTP Range requests, each one writing its own slice of the file.
+    """
+    with open(tmp_fullname, "wb") as f:
+        _preallocate(f, total_size)
+
+    part_size = -(-total_size // num_workers)
+    ranges = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+
+    with tqdm(total=total_size, unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+
+        def _fetch(byte_range):
+            start, end = byte_range
+            req = _SESSION.get(url, headers={"Range": "bytes={}-{}".format(start, end)}, stream=True)
+            if req.status_code != 206:
+                raise RuntimeError("Downloading range of {} failed with code {}!".format(url, req.status_code))
+            received = 0
+            with open(tmp_fullname, "r+b") as f:
+                f.seek(start)
+                for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+                    pbar.update(len(chunk))
+            if received != end - start + 1:
+                raise RuntimeError("Downloading range of {} was interrupted.".format(url))
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            # consuming the results re-raises the first failed range
+            list(executor.map(_fetch, ranges))
+
+
+def _md5_record_path(fullname):
+    # verified md5 records live in a private `.md5` directory next to the file, like `.lock`
+    return osp.join(osp.dirname(fullname), ".md5", osp.basename(fullname))
+
+
 def _md5check(fullname, md5sum=None):
     if md5sum is None:
         return True
 
+    # skip rehashing a file that was already verified and has not changed since
+    stat = os.stat(fullname)
+    record = {"md5": md5sum, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    record_path = _md5_record_path(fullname)
+    try:
+        with open(record_path, "r", encoding="utf-8") as f:
+            if json.load(f) == record:
+                return True
+    except (OSError, ValueError):
+        pass
+
     logger.info("File {} md5 checking...".format(fullname))
-    md5 = hashlib.md5()
     with open(fullname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5.update(chunk)
-    calc_md5sum = md5.hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            # python>=3.11 hashes the file in C with a large buffer
+            calc_md5sum = hashlib.file_digest(f, "md5").hexdigest()
+        else:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                md5.update(chunk)
+            calc_md5sum = md5.hexdigest()
 
     if calc_md5sum != md5sum:
         logger.info("File {} md5 check failed, {}(calc) != " "{}(base)".format(fullname, calc_md5sum, md5sum))
         return False
+
+    try:
+        os.makedirs(osp.dirname(record_path), exist_ok=True)
+        with open(record_path, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+    except OSError:
+        # read-only caches still work, they just rehash next time
+        pass
     return True
 
 
@@ -253,6 +409,20 @@ def _decompress(fname):
     """
     Decompress for zip and tar file
     """
+    # an archive that was extracted completely and has not changed since is not extracted again
+    stat = os.stat(fname)
+    record = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    record_path = osp.join(osp.dirname(fname), ".extracted", osp.basename(fname))
+    try:
+        with open(record_path, "r", encoding="utf-8") as f:
+            extracted = json.load(f)
+        uncompressed_path = osp.join(osp.dirname(fname), extracted.pop("path"))
+        if extracted == record and osp.exists(uncompressed_path):
+            logger.info("Found decompressed {}".format(uncompressed_path))
+            return uncompressed_path
+    except (OSError, ValueError, KeyError):
+        pass
+
     logger.info("Decompressing {}...".format(fname))
 
     # For protecting decompressing interupted,
@@ -267,12 +437,20 @@ def _decompress(fname):
     else:
         raise TypeError("Unsupport compress file type {}".format(fname))
 
+    try:
+        os.makedirs(osp.dirname(record_path), exist_ok=True)
+        with open(record_path, "w", encoding="utf-8") as f:
+            json.dump(dict(record, path=osp.relpath(uncompressed_path, osp.dirname(fname))), f)
+    except OSError:
+        pass
+
     return uncompressed_path
 
 
 def _uncompress_file_zip(filepath):
     files = zipfile.ZipFile(filepath, "r")
-    file_list = files.namelist()
+    members = files.infolist()
+    file_list = [member.filename for member in members]
 
     file_dir = os.path.dirname(filepath)
 
@@ -280,14 +458,14 @@ def _uncompress_file_zip(filepath):
         rootpath = file_list[0]
         uncompressed_path = os.path.join(file_dir, rootpath)
 
-        for item in file_list:
+        for item in members:
             files.extract(item, file_dir)
 
     elif _is_a_single_dir(file_list):
         rootpath = os.path.splitext(file_list[0])[0].split(os.sep)[-1]
         uncompressed_path = os.path.join(file_dir, rootpath)
 
-        for item in file_list:
+        for item in members:
             files.extract(item, file_dir)
 
     else:
@@ -295,7 +473,7 @@ def _uncompress_file_zip(filepath):
         uncompressed_path = os.path.join(file_dir, rootpath)
         if not os.path.exists(uncompressed_path):
             os.makedirs(uncompressed_path)
-        for item in file_list:
+        for item in members:
             files.extract(item, os.path.join(file_dir, rootpath))
 
     files.close()
@@ -304,33 +482,78 @@ def _uncompress_file_zip(filepath):
 
 
 def _uncompress_file_tar(filepath, mode="r:*"):
-    files = tarfile.open(filepath, mode)
-    file_list = files.getnames()
+    files = None
+    # with pigz both the listing and the extraction skip python's single-core gzip
+    file_list = _list_tar_with_pigz(filepath) if _use_pigz(filepath) else None
+    if file_list is None:
+        files = tarfile.open(filepath, mode)
+        # read the member index once and reuse it for the names and the extraction
+        members = files.getmembers()
+        file_list = [member.name for member in members]
     file_dir = os.path.dirname(filepath)
 
     if _is_a_single_file(file_list):
         rootpath = file_list[0]
         uncompressed_path = os.path.join(file_dir, rootpath)
-        files.extractall(file_dir, files.getmembers())
+        target_dir = file_dir
     elif _is_a_single_dir(file_list):
         rootpath = os.path.splitext(file_list[0])[0].split(os.sep)[-1]
         uncompressed_path = os.path.join(file_dir, rootpath)
-        files.extractall(file_dir, files.getmembers())
+        target_dir = file_dir
     else:
         rootpath = os.path.splitext(filepath)[0].split(os.sep)[-1]
         uncompressed_path = os.path.join(file_dir, rootpath)
         if not os.path.exists(uncompressed_path):
             os.makedirs(uncompressed_path)
+        target_dir = os.path.join(file_dir, rootpath)
 
-        files.extractall(os.path.join(file_dir, rootpath), files.getmembers())
-
-    files.close()
+    if files is not None:
+        files.extractall(target_dir, members)
+        files.close()
+    elif _pigz_tar(filepath, ["-xf", "-", "-C", target_dir]) is None:
+        logger.warning(
+            "Extracting {} with pigz failed, extracting it again with tarfile over the partially "
+            "extracted files in {}.".format(filepath, target_dir)
+        )
+        with tarfile.open(filepath, mode) as files:
+            files.extractall(target_dir)
 
     return uncompressed_path
 
 
+def _use_pigz(filepath):
+    # python's gzip decompresses on a single core, use pigz for .tar.gz when it is installed
+    return filepath.endswith((".tar.gz", ".tgz")) and shutil.which("pigz") and shutil.which("tar")
+
+
+def _pigz_tar(filepath, tar_args):
+    """
+    Run `tar tar_args` on the output of `pigz -dc filepath`, return the stdout of tar or None if either fails.
+    """
+    try:
+        with subprocess.Popen(["pigz", "-dc", filepath], stdout=subprocess.PIPE) as pigz:
+            tar = subprocess.Popen(["tar"] + tar_args, stdin=pigz.stdout, stdout=subprocess.PIPE)
+            # let pigz see a closed pipe if tar exits early
+            pigz.stdout.close()
+            output, _ = tar.communicate()
+            if tar.returncode == 0 and pigz.wait() == 0:
+                return output
+    except OSError:
+        pass
+    return None
+
+
+def _list_tar_with_pigz(filepath):
+    # literal quoting keeps the names as stored, tar implementations without the option fall back to tarfile
+    output = _pigz_tar(filepath, ["--quoting-style=literal", "-tf", "-"])
+    if output is None:
+        return None
+    # tarfile reports directories without the trailing slash
+    return [name.rstrip("/") for name in os.fsdecode(output).splitlines()]
+
+
 def _is_a_single_file(file_list):
-    if len(file_list) == 1 and file_list[0].find(os.sep) < -1:
+    if len(file_list) == 1 and file_list[0].find(os.sep) < 0:
         return True
     return False
 
@@ -357,7 +580,8 @@ class DownloaderCheck(threading.Thread):
     """
 
     def __init__(self, task, command="taskflow", addition=None):
-        threading.Thread.__init__(self)
+        # never keep the interpreter alive for the stat request
+        threading.Thread.__init__(self, daemon=True)
         self.command = command
         self.task = task
         self.addition = addition
@@ -378,27 +602,19 @@ class DownloaderCheck(threading.Thread):
         etime = str(int(time.time()))
         self.full_hash_flag = _md5(str(uuid.uuid1())[-12:])
         self.hash_flag = _md5(str(uuid.uuid1())[9:18]) + "-" + etime
+        # only the time field changes between requests
+        self._extra = {
+            "command": self.command,
+            "hub_name": self.hash_flag,
+            "cache_info": self.full_hash_flag,
+        }
 
     def request_check(self, task, command, addition):
         if task is None:
             return SUCCESS_STATUS
         payload = {"word": self.task}
         api_url = self.uri_path(DOWNLOAD_SERVER, "stat")
-        cache_path = os.path.join("～")
-        if os.path.exists(cache_path):
-            extra = {
-                "command": self.command,
-                "mtime": os.stat(cache_path).st_mtime,
-                "hub_name": self.hash_flag,
-                "cache_info": self.full_hash_flag,
-            }
-        else:
-            extra = {
-                "command": self.command,
-                "mtime": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
-                "hub_name": self.hash_flag,
-                "cache_info": self.full_hash_flag,
-            }
+        extra = dict(self._extra, mtime=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
         if addition is not None:
             extra.update({"addition": addition})
         try:
@@ -411,7 +627,7 @@ class DownloaderCheck(threading.Thread):
             payload["paddle_version"] = paddle.__version__.split("-")[0]
             payload["from"] = "ppnlp"
             payload["extra"] = json.dumps(extra)
-            r = requests.get(api_url, payload, timeout=1).json()
+            r = _SESSION.get(api_url, params=payload, timeout=1).json()
             if r.get("update_cache", 0) == 1:
                 return SUCCESS_STATUS
             else:
@@ -429,8 +645,8 @@ def download_check(model_id, model_class, addition=None):
     if not DOWNLOAD_CHECK:
         DOWNLOAD_CHECK = True
         checker = DownloaderCheck(model_id, model_class, addition)
+        # fire and forget, model loading does not wait for the stat request
         checker.start()
-        checker.join()
     logger.enable()
 
 
@@ -448,7 +664,7 @@ def url_file_exists(url: str) -> bool:
     if not is_url(url):
         return False
 
-    result = requests.head(url)
+    result = _SESSION.head(url, timeout=(3, 5), allow_redirects=True)
     return result.status_code == requests.codes.ok
 
 
@@ -15,10 +15,12 @@
 
 import unittest
 
+import paddle
 from parameterized import parameterized_class
 
 from paddlenlp.transformers.qwen.configuration import QWenConfig
 from paddlenlp.transformers.qwen.modeling import QWenForCausalLM, QWenModel
+from paddlenlp.transformers.qwen.modeling_network import GlobalNet
 from tests.transformers.test_generation_utils import GenerationTesterMixin
 
 from ..test_modeling_common import ModelTesterMixin, ids_tensor, random_attention_mask
@@ -235,3 +237,47 @@ class QWenModelTest(ModelTesterMixin, GenerationTesterMixin, unittest.TestCase):
     def test_for_causal_lm(self):
         config_and_inputs = self.model_tester.prepare_config_and_inputs()
         self.model_tester.create_and_check_for_causal_model(*config_and_inputs)
+
+
+class QWenGlobalNetTest(unittest.TestCase):
+    def setUp(self):
+        self.global_net = GlobalNet(QWenConfig(max_position_embeddings=16))
+
+    def reference_mask(self, seq_length, past_length, dtype=paddle.float32):
+        total_length = seq_length + past_length
+        causal = paddle.tril(paddle.ones([total_length, total_length], dtype="bool"))[past_length:]
+        return paddle.where(
+            causal, paddle.zeros([], dtype=dtype), paddle.full([], paddle.finfo(dtype).min, dtype=dtype)
+        )
+
+    def check_mask(self, seq_length, past_length):
+        mask = self.global_net.get_causal_mask(seq_length, past_length, paddle.float32)
+        self.assertEqual(mask.shape, [1, 1, seq_length, seq_length + past_length])
+        self.assertTrue(paddle.equal_all(mask[0, 0], self.reference_mask(seq_length, past_length)).item())
+
+    def test_cache_grows_geometrically(self):
+        self.check_mask(5, 0)
+        self.assertEqual(self.global_net._causal_mask_cache.shape[-1], 5)
+        self.check_mask(6, 0)
+        self.assertEqual(self.global_net._causal_mask_cache.shape[-1], 10)
+        # shorter inputs are sliced from the cache
+        self.check_mask(3, 0)
+        self.assertEqual(self.global_net._causal_mask_cache.shape[-1], 10)
+        # doubling is capped at max_position_embeddings
+        self.check_mask(11, 0)
+        self.assertEqual(self.global_net._causal_mask_cache.shape[-1], 16)
+        # but never below the requested length
+        self.check_mask(20, 0)
+        self.assertEqual(self.global_net._causal_mask_cache.shape[-1], 20)
+
+    def test_decode_builds_rows_only(self):
+        for seq_length, past_length in [(1, 7), (1, 30), (3, 5)]:
+            self.check_mask(seq_length, past_length)
+        # decoding past the cache must not rebuild the full square mask
+        self.assertIsNone(self.global_net._causal_mask_cache)
+
+    def test_decode_slices_cache(self):
+        self.check_mask(8, 0)
+        self.check_mask(1, 6)
+        self.check_mask(2, 5)
+        self.assertEqual(self.global_net._causal_mask_cache.shape[-1], 8)
@@ -60,3 +60,74 @@ class LockFileTest(unittest.TestCase):
             _ = os.open(lock_file_path, open_mode)
             config_file = get_path_from_url_with_filelock(self.test_url, root_dir=tempdir)
             self.assertIsNotNone(config_file)
+
+
+class MD5CheckTest(unittest.TestCase):
+    def test_md5check_with_record(self):
+
+        from paddlenlp.utils.downloader import _md5_record_path, _md5check
+
+        with TemporaryDirectory() as tempdir:
+            file_path = os.path.join(tempdir, "vocab.txt")
+            with open(file_path, "wb") as f:
+                f.write(b"temp test")
+            md5sum = hashlib.md5(b"temp test").hexdigest()
+
+            self.assertFalse(_md5check(file_path, "0" * 32))
+            self.assertFalse(os.path.exists(_md5_record_path(file_path)))
+
+            self.assertTrue(_md5check(file_path, md5sum))
+            self.assertTrue(os.path.exists(_md5_record_path(file_path)))
+            # the verified record is reused for the unchanged file
+            self.assertTrue(_md5check(file_path, md5sum))
+
+            # a changed file is rehashed instead of trusting the record
+            with open(file_path, "wb") as f:
+                f.write(b"changed content")
+            self.assertFalse(_md5check(file_path, md5sum))
+
+
+class DecompressTest(unittest.TestCase):
+    def test_decompress_single_file_archive(self):
+        import tarfile
+
+        from paddlenlp.utils.downloader import _decompress
+
+        with TemporaryDirectory() as tempdir:
+            file_path = os.path.join(tempdir, "vocab.txt")
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write("temp test")
+            archive_path = os.path.join(tempdir, "vocab.tar.gz")
+            with tarfile.open(archive_path, "w:gz") as tar:
+                tar.add(file_path, "vocab.txt")
+            os.remove(file_path)
+
+            uncompressed_path = _decompress(archive_path)
+            self.assertEqual(uncompressed_path, file_path)
+            self.assertTrue(os.path.isfile(uncompressed_path))
+
+    def test_decompress_skips_extracted_archive(self):
+        import tarfile
+
+        from paddlenlp.utils.downloader import _decompress
+
+        with TemporaryDirectory() as tempdir:
+            file_path = os.path.join(tempdir, "vocab.txt")
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write("temp test")
+            archive_path = os.path.join(tempdir, "vocab.tar.gz")
+            with tarfile.open(archive_path, "w:gz") as tar:
+                tar.add(file_path, "vocab.txt")
+
+            self.assertEqual(_decompress(archive_path), file_path)
+            # an already extracted archive is not extracted again
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write("local change")
+            self.assertEqual(_decompress(archive_path), file_path)
+            with open(file_path, "r", encoding="utf-8") as f:
+                self.assertEqual(f.read(), "local change")
+
+            # a missing extraction is restored
+            os.remove(file_path)
+            self.assertEqual(_decompress(archive_path), file_path)
+            self.assertTrue(os.path.isfile(file_path))